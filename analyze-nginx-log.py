@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import argparse
+import logging
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+GZIP_MAGIC = b"\x1f\x8b"
+MAX_CLIENTS = 1000000
+
+
+def open_log(filename):
+    with open(filename, "rb") as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(filename, "rt", encoding="utf8", errors="replace")
+    return open(filename, "rt", encoding="utf8", errors="replace")
+
+
+def parse_line(line):
+    """Return (client, "[timestamp]") like the awk passes of analyze-nginx-log.sh"""
+    head = line.rstrip("\n").split("]", 1)[0] + "]"
+    client, sep, timestamp = head.partition(" - - ")
+    if not sep:
+        return head, ""
+    return client, timestamp.split(" - - ", 1)[0]
+
+
+def analyze_log(filename, max_clients=MAX_CLIENTS):
+    """Stream one log and return {client: [first timestamp, count]} in first-seen order
+
+    At most max_clients clients are tracked; requests of any other client are
+    only counted as overflow, since this file alone cannot tell whether the
+    merged result tracks that client.
+    """
+    clients = {}
+    overflow = 0
+    with open_log(filename) as f:
+        for line in f:
+            client, timestamp = parse_line(line)
+            entry = clients.get(client)
+            if entry is not None:
+                entry[1] += 1
+            elif len(clients) < max_clients:
+                clients[client] = [timestamp, 1]
+            else:
+                overflow += 1
+    return filename, clients, overflow
+
+
+def analyze_logs(filenames, jobs=None, max_clients=MAX_CLIENTS):
+    """Merge per-file results in file order
+
+    Return (clients, dropped, unattributed): dropped counts requests of
+    clients left out once the cap was reached while merging, unattributed
+    counts requests a worker could not track because its file alone had more
+    than max_clients clients, so their clients' totals may be low.
+    """
+    jobs = jobs or os.cpu_count()
+    clients = {}
+    dropped = 0
+    unattributed = 0
+    pending = collections.deque()
+    filenames = iter(filenames)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            # bound the finished but not yet merged results kept in memory
+            for filename in itertools.islice(filenames, 2 * jobs - len(pending)):
+                pending.append(executor.submit(analyze_log, filename, max_clients))
+            if not pending:
+                break
+            # merge in file order so the first timestamp matches the shell script
+            filename, file_clients, overflow = pending.popleft().result()
+            logging.info("analyzed {}: {} clients".format(filename, len(file_clients)))
+            unattributed += overflow
+            for client, (timestamp, count) in file_clients.items():
+                entry = clients.get(client)
+                if entry is not None:
+                    entry[1] += count
+                elif len(clients) < max_clients:
+                    clients[client] = [timestamp, count]
+                else:
+                    dropped += count
+    return clients, dropped, unattributed
+
+
+def main():
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format="[%(asctime)s]:%(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="extract unique clients from plain or gzipped nginx logs",
+    )
+    parser.add_argument("log_dir", nargs="?", default="./nginx-log")
+    parser.add_argument("-o", "--output", default="nginx-log.unique")
+    parser.add_argument(
+        "-j", "--jobs", default=os.cpu_count(), type=int, help="worker processes"
+    )
+    parser.add_argument(
+        "-c",
+        "--count",
+        default=False,
+        action="store_true",
+        help="append the number of requests of each client",
+    )
+    parser.add_argument(
+        "--max-clients",
+        default=MAX_CLIENTS,
+        type=int,
+        help="track at most this many clients in the merge and in each worker, "
+        "bounding memory to about 2 * jobs + 1 such sets; clients seen after "
+        "the cap is reached are left out of the output",
+    )
+    args = parser.parse_args()
+
+    filenames = sorted(
+        os.path.join(args.log_dir, name)
+        for name in os.listdir(args.log_dir)
+        if os.path.isfile(os.path.join(args.log_dir, name))
+    )
+    clients, dropped, unattributed = analyze_logs(
+        filenames, jobs=args.jobs, max_clients=args.max_clients
+    )
+    with open(args.output, "w") as f:
+        for client, (timestamp, count) in clients.items():
+            if args.count:
+                f.write("{}  {}  {}\n".format(client, timestamp, count))
+            else:
+                f.write("{}  {}\n".format(client, timestamp))
+    logging.info("wrote {} clients to {}".format(len(clients), args.output))
+    if dropped:
+        logging.warning(
+            "{} requests from clients beyond --max-clients were dropped".format(
+                dropped
+            )
+        )
+    if unattributed:
+        logging.warning(
+            "{} requests in files with more than --max-clients clients were not "
+            "attributed, counts may be low".format(unattributed)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,59 @@
 #!/usr/bin/env python3
+import os
+import math
+import struct
 import socket
 import argparse
+import selectors
+import multiprocessing
+import time
 
 UDP_IP = "0.0.0.0"
 UDP_PORT = 987
+BENCH_PORT = 19987
+REQUEST_ID_HEADER = b"x-request-id"
 
 
-def reply_always(host_type, verbose=False):
+def parse_request_id(data):
+    for line in data.split(b"\r\n"):
+        name, sep, value = line.partition(b":")
+        if sep and name.strip().lower() == REQUEST_ID_HEADER:
+            return value.strip()
+    return None
+
+
+def kernel_drops(sock):
+    # the last column of /proc/net/udp is the per-socket drop counter
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    try:
+        with open("/proc/net/udp") as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 12 and fields[9] == inode:
+                    return int(fields[12])
+    except OSError:
+        pass
+    return 0
+
+
+def bind_socket(bind_ip=UDP_IP, port=UDP_PORT):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((UDP_IP, UDP_PORT))
+    sock.bind((bind_ip, port))
+    return sock
+
+
+def reply_always(
+    host_type, verbose=False, bind_ip=UDP_IP, port=UDP_PORT, stats_interval=10.0
+):
+    serve(bind_socket(bind_ip, port), host_type, verbose, stats_interval)
+
+
+def serve(sock, host_type, verbose=False, stats_interval=10.0):
+    # a kernel receive timeout wakes recvfrom for the stats line without the
+    # poll() python adds to every call on a socket with settimeout()
+    sec, usec = divmod(int(stats_interval * 1000000), 1000000)
+    sock.settimeout(None)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", sec, usec))
 
     text = """HTTP/1.1 200 OK\r
 host-id:0123456789AB\r
@@ -19,37 +64,153 @@ device-discovery-protocol-version:00020020\r
 system-version:07020001\r
 running-app-name:Youtube\r
 running-app-titleid:CUSA01116\r
-\r
 """
     count = 0
+    send_errors = 0
+    last_count = 0
+    last_drops = kernel_drops(sock)
+    last_time = time.monotonic()
     while True:
-        data, addr = sock.recvfrom(1024)
-        if verbose:
-            msg = "received message from %s[%d]: %s" % (
-                addr[0],
-                addr[1],
-                data.decode("utf8"),
-            )
-            print(msg)
+        try:
+            data, addr = sock.recvfrom(1024)
+        except BlockingIOError:
+            data = None
+        if data is not None:
+            if verbose:
+                msg = "received message from %s[%d]: %s" % (
+                    addr[0],
+                    addr[1],
+                    data.decode("utf8", errors="replace"),
+                )
+                print(msg)
 
-        response = text.format(host_type, host_type, addr[1])
-        if verbose:
-            print(response)
-        sock.sendto(response.encode("utf8"), addr)
-        count += 1
-        if count % 1000 == 0:
-            print("received {} requests".format(count))
+            response = text.format(host_type, host_type, addr[1]).encode("utf8")
+            request_id = parse_request_id(data)
+            if request_id is not None:
+                response += REQUEST_ID_HEADER + b":" + request_id + b"\r\n"
+            response += b"\r\n"
+            if verbose:
+                print(response.decode("utf8", errors="replace"))
+            try:
+                sock.sendto(response, addr)
+            except OSError:
+                send_errors += 1
+            count += 1
 
+        now = time.monotonic()
+        if now - last_time < stats_interval:
+            continue
+        drops = kernel_drops(sock) + send_errors
+        if count != last_count or drops != last_drops:
+            print(
+                "received {} requests, {:.1f} pps, {} drops".format(
+                    count, (count - last_count) / (now - last_time), drops - last_drops
+                ),
+                flush=True,
+            )
+        last_count, last_drops, last_time = count, drops, now
 
-def ask_response(ask_ip):
+
+def ask_response(ask_ip, port=UDP_PORT):
     text = "SRCH * HTTP/1.1\r\n\r\n"
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
-    sock.sendto(bytes(text, "utf-8"), (ask_ip, UDP_PORT))
-    print("send to {}: {}".format((ask_ip, UDP_PORT), text))
+    sock.sendto(bytes(text, "utf-8"), (ask_ip, port))
+    print("send to {}: {}".format((ask_ip, port), text))
     data, addr = sock.recvfrom(1024)
     print("received message from %s[%d]: %s" % (addr[0], addr[1], data.decode("utf8")))
 
 
+def percentile(values, pct):
+    # nearest-rank percentile of an already sorted list
+    if not values:
+        return float("nan")
+    rank = max(0, min(len(values) - 1, math.ceil(pct / 100.0 * len(values)) - 1))
+    return values[rank]
+
+
+def bench_response(
+    ask_ip, port=UDP_PORT, rate=1000, duration=10.0, sockets=16, timeout=1.0
+):
+    selector = selectors.DefaultSelector()
+    socks = []
+    for _ in range(sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect((ask_ip, port))
+        selector.register(sock, selectors.EVENT_READ)
+        socks.append(sock)
+
+    pending = {}
+    latencies = []
+    sent = 0
+    send_errors = 0
+    unmatched = 0
+    interval = 1.0 / rate
+    start = time.monotonic()
+    stop_send = start + duration
+    next_send = start
+    while True:
+        now = time.monotonic()
+        if now >= stop_send and (not pending or now >= stop_send + timeout):
+            break
+        while now < stop_send and next_send <= now:
+            request_id = str(sent).encode("utf8")
+            text = b"SRCH * HTTP/1.1\r\n" + REQUEST_ID_HEADER + b":" + request_id
+            try:
+                socks[sent % len(socks)].send(text + b"\r\n\r\n")
+                pending[request_id] = time.monotonic()
+            except OSError:
+                send_errors += 1
+            sent += 1
+            next_send += interval
+        if now < stop_send:
+            wait = max(0.0, next_send - time.monotonic())
+        else:
+            wait = max(0.0, stop_send + timeout - time.monotonic())
+        for key, _ in selector.select(wait):
+            while True:
+                try:
+                    data = key.fileobj.recv(1024)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break
+                received = time.monotonic()
+                send_time = pending.pop(parse_request_id(data), None)
+                if send_time is None:
+                    unmatched += 1
+                    continue
+                latencies.append(received - send_time)
+    elapsed = time.monotonic() - start
+    for sock in socks:
+        selector.unregister(sock)
+        sock.close()
+    selector.close()
+
+    latencies.sort()
+    lost = sent - len(latencies)
+    print(
+        "sent {} requests in {:.2f}s from {} ports, {:.1f} req/s".format(
+            sent, duration, sockets, sent / duration
+        )
+    )
+    print(
+        "received {} replies, {:.1f} replies/s, lost {} ({:.2f}%), "
+        "send errors {}, unmatched {}".format(
+            len(latencies),
+            len(latencies) / elapsed,
+            lost,
+            100.0 * lost / sent if sent else 0.0,
+            send_errors,
+            unmatched,
+        )
+    )
+    print(
+        "latency ms: p50 {:.3f} p90 {:.3f} p99 {:.3f} p99.9 {:.3f} max {:.3f}".format(
+            *[percentile(latencies, pct) * 1000 for pct in (50, 90, 99, 99.9, 100)]
+        )
+    )
+    return lost
+
+
 def main():
     parser = argparse.ArgumentParser(description="Phony game host type")
     parser.add_argument(
@@ -70,11 +231,92 @@ def main():
         "--verbose", default=False, action="store_true", help="enable verbose output"
     )
 
+    parser.add_argument("--bind-ip", default=UDP_IP)
+    parser.add_argument(
+        "--port",
+        default=None,
+        type=int,
+        help="UDP port, default {} or {} with --bench-local".format(
+            UDP_PORT, BENCH_PORT
+        ),
+    )
+    parser.add_argument(
+        "--stats-interval",
+        default=10.0,
+        type=float,
+        help="seconds between server stats lines",
+    )
+
     parser.add_argument("--ask-ip", default=None)
+    parser.add_argument(
+        "--bench",
+        default=False,
+        action="store_true",
+        help="send SRCH requests to --ask-ip (default 127.0.0.1) and report "
+        "throughput, loss and latency instead of serving",
+    )
+    parser.add_argument(
+        "--bench-local",
+        default=False,
+        action="store_true",
+        help="start a server on 127.0.0.1 for the duration of --bench",
+    )
+    parser.add_argument("--bench-rate", default=1000, type=float, help="requests/s")
+    parser.add_argument("--bench-duration", default=10.0, type=float)
+    parser.add_argument(
+        "--bench-sockets", default=16, type=int, help="concurrent source ports"
+    )
+    parser.add_argument(
+        "--bench-timeout",
+        default=1.0,
+        type=float,
+        help="seconds to wait for replies after the last request",
+    )
     args = parser.parse_args()
+    for name in ["stats_interval", "bench_rate", "bench_duration", "bench_sockets"]:
+        if getattr(args, name) <= 0:
+            parser.error("--{} must be positive".format(name.replace("_", "-")))
+    port = args.port
+    if port is None:
+        port = BENCH_PORT if args.bench and args.bench_local else UDP_PORT
+    if args.bench:
+        ask_ip = args.ask_ip
+        server = None
+        if args.bench_local:
+            ask_ip = "127.0.0.1"
+            # bind here so a busy port fails the bench instead of losing 100%
+            sock = bind_socket(ask_ip, port)
+            server = multiprocessing.Process(
+                target=serve,
+                args=(sock, args.host_type),
+                kwargs={"stats_interval": args.stats_interval},
+                daemon=True,
+            )
+            server.start()
+            sock.close()
+        try:
+            lost = bench_response(
+                ask_ip or "127.0.0.1",
+                port=port,
+                rate=args.bench_rate,
+                duration=args.bench_duration,
+                sockets=args.bench_sockets,
+                timeout=args.bench_timeout,
+            )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join()
+        raise SystemExit(1 if lost else 0)
     if args.ask_ip is not None:
-        ask_response(args.ask_ip)
-    reply_always(args.host_type, verbose=args.verbose)
+        ask_response(args.ask_ip, port=port)
+    reply_always(
+        args.host_type,
+        verbose=args.verbose,
+        bind_ip=args.bind_ip,
+        port=port,
+        stats_interval=args.stats_interval,
+    )
 
 
 if __name__ == "__main__":
@@ -5,6 +5,10 @@ import subprocess
 import shutil
 import json
 import logging
+import fcntl
+import stat
+import tempfile
+import contextlib
 
 
 def get_latest_release(platform, arch):
@@ -36,18 +40,151 @@ def download_release_file(commit, prefix, arch, archive_file):
     return
 
 
-def prepare_release_dir(commit, archive_file, output_dir):
+@contextlib.contextmanager
+def file_lock(lock_file):
+    """Hold an exclusive flock on lock_file, shared by all processes on the host"""
+    while True:
+        # O_CREAT on another user's file in a sticky dir fails with
+        # fs.protected_regular, so only create the lock when it is missing
+        try:
+            fd = os.open(lock_file, os.O_RDONLY | os.O_NOFOLLOW)
+            break
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(lock_file, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.fchmod(fd, 0o644)
+            break
+        except FileExistsError:
+            continue
+    try:
+        logging.info("waiting for lock {}".format(lock_file))
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def is_trusted_dir(path, group=None):
+    """A real directory that only we, root or the cache group can write to"""
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_mode & stat.S_IWOTH:
+        return False
+    if st.st_mode & stat.S_IWGRP and group is not None and st.st_gid != group:
+        return False
+    return st.st_uid in [os.getuid(), 0] or (group is not None and st.st_gid == group)
+
+
+def make_cache_dir(path, group=None):
+    if not os.path.lexists(path):
+        with contextlib.suppress(FileExistsError):
+            os.mkdir(path)
+            os.chmod(path, 0o2775 if group is not None else 0o755)
+    return is_trusted_dir(path, group)
+
+
+def normalize_modes(top_dir):
+    # tar applies the umask of whoever extracts, make the tree readable by all
+    for root, dirs, files in os.walk(top_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                continue
+            if stat.S_ISDIR(st.st_mode) or st.st_mode & 0o111:
+                os.chmod(path, 0o755)
+            else:
+                os.chmod(path, 0o644)
+    os.chmod(top_dir, 0o755)
+
+
+def extract_release(archive_file, release_dir):
+    staging_dir = tempfile.mkdtemp(
+        prefix=".{}.".format(os.path.basename(release_dir)),
+        dir=os.path.dirname(release_dir),
+    )
+    try:
+        assert shutil.which("tar")
+        tar_args = "--no-same-owner -xz --strip-components=1 "
+        command = "tar {} -C {} -f {}".format(tar_args, staging_dir, archive_file)
+        logging.info("extract files from {} to {}".format(archive_file, staging_dir))
+        subprocess.check_call(command, shell=True, text=True, env=os.environ)
+        normalize_modes(staging_dir)
+        os.rename(staging_dir, release_dir)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+
+def prepare_cached_release(commit, prefix, arch, cache_dir):
+    """Download and extract a release once per cache, return the extracted dir
+
+    The cache root must be owned by us or root and not world-writable; if it
+    is group-writable, the members of its group share the cache. Return None
+    when the cache or the cached release cannot be trusted.
+    """
+    name = "vscode-{}-{}-{}".format(prefix, arch, commit)
+    if not os.path.lexists(cache_dir):
+        os.makedirs(cache_dir, mode=0o755, exist_ok=True)
+    st = os.lstat(cache_dir)
+    group = st.st_gid if st.st_mode & stat.S_IWGRP else None
+    if not is_trusted_dir(cache_dir) or st.st_uid not in [os.getuid(), 0]:
+        logging.warning("untrusted cache directory {}".format(cache_dir))
+        return None
+    for sub_dir in ["archives", "releases", "locks"]:
+        sub_dir_path = os.path.join(cache_dir, sub_dir)
+        if not make_cache_dir(sub_dir_path, group):
+            logging.warning("untrusted cache directory {}".format(sub_dir_path))
+            return None
+    release_dir = os.path.join(cache_dir, "releases", name)
+    if not os.path.lexists(release_dir):
+        with file_lock(os.path.join(cache_dir, "locks", "{}.lock".format(name))):
+            # another process may have published it while we were waiting
+            if not os.path.lexists(release_dir):
+                download_release(commit, prefix, arch, cache_dir, release_dir)
+    if not is_trusted_dir(release_dir, group):
+        logging.warning("untrusted cached release {}".format(release_dir))
+        return None
+    logging.info("use cached release {}".format(release_dir))
+    return release_dir
+
+
+def download_release(commit, prefix, arch, cache_dir, release_dir):
+    # a per-process archive, so an interrupted download never leaves a file
+    # that other users can neither resume nor remove
+    fd, archive_file = tempfile.mkstemp(
+        prefix="{}.".format(os.path.basename(release_dir)),
+        suffix=".tar.gz",
+        dir=os.path.join(cache_dir, "archives"),
+    )
+    os.close(fd)
+    try:
+        download_release_file(
+            commit=commit, prefix=prefix, arch=arch, archive_file=archive_file
+        )
+        extract_release(archive_file, release_dir)
+    finally:
+        os.remove(archive_file)
+
+
+def prepare_release_dir(commit, release_dir, output_dir):
     bin_dir = os.path.join(output_dir, "bin")
     commit_dir = os.path.join(bin_dir, commit)
-    if os.path.exists(commit_dir):
-        shutil.rmtree(commit_dir)
-    if not os.path.exists(commit_dir):
-        os.makedirs(commit_dir)
-    assert shutil.which("tar")
-    tar_args = "--no-same-owner -xz --strip-components=1 "
-    command = "tar {} -C {} -f {}".format(tar_args, commit_dir, archive_file)
-    logging.info("extract files from {} to {}".format(archive_file, commit_dir))
-    subprocess.check_call(command, shell=True, text=True, env=os.environ)
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir, exist_ok=True)
+    with file_lock(os.path.join(bin_dir, ".{}.lock".format(commit))):
+        if os.path.exists(commit_dir):
+            logging.info("{} already installed".format(commit_dir))
+            return
+        staging_dir = tempfile.mkdtemp(prefix=".{}.".format(commit), dir=bin_dir)
+        try:
+            logging.info("copy files from {} to {}".format(release_dir, commit_dir))
+            shutil.copytree(release_dir, staging_dir, symlinks=True, dirs_exist_ok=True)
+            os.rename(staging_dir, commit_dir)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
 
 
 def main():
@@ -64,6 +201,12 @@ def main():
     parser.add_argument("-a", "--arch", default=None, choices=valid_arch)
     parser.add_argument("-c", "--commit", default=None, help="the commit id")
     parser.add_argument("-o", "--output-dir", default="./", help="the output directory")
+    parser.add_argument(
+        "--cache-dir",
+        default="/var/tmp/vscode-download-server",
+        help="the download cache, shared by the group of a 2775 directory "
+        "owned by root; falls back to a private cache if it is not trusted",
+    )
     args = parser.parse_args()
     arch = args.arch
     platform = args.platform
@@ -85,14 +228,21 @@ def main():
     prefix = "server-{}".format(platform)
     if platform == "alpine":
         prefix = "cli-{}".format(platform)
-    archive_name = "vscode-{}-{}-{}.tar.gz".format(prefix, arch, commit)
-    archive_file = os.path.join(args.output_dir, archive_name)
-    download_release_file(
-        commit=commit, prefix=prefix, arch=arch, archive_file=archive_file
+    release_dir = prepare_cached_release(
+        commit=commit, prefix=prefix, arch=arch, cache_dir=args.cache_dir
     )
+    if release_dir is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+        cache_dir = os.path.join(cache_home, "vscode-download-server")
+        logging.warning("fall back to the private cache {}".format(cache_dir))
+        os.makedirs(cache_home, exist_ok=True)
+        release_dir = prepare_cached_release(
+            commit=commit, prefix=prefix, arch=arch, cache_dir=cache_dir
+        )
+        assert release_dir, "no usable cache directory"
     prepare_release_dir(
         commit=commit,
-        archive_file=archive_file,
+        release_dir=release_dir,
         output_dir=os.path.join(args.output_dir, "vscode-server"),
     )
     return